@@ -4,8 +4,11 @@ versions of each course. The table will be saved as a csv file and uploaded to S
 
 """
 import csv
-import os
+import gzip
+import io
 import re
+from collections import deque
+from sys import intern
 
 import bson
 import pymysql
@@ -15,7 +18,59 @@ import pymongo.errors
 from panorama_elt.panorama_datalake.panorama_datalake import PanoramaDatalake
 from panorama_elt.panorama_logger.setup_logger import log
 
-filename = 'course_structures.csv'
+filename = 'course_structures.csv.gz'
+
+# Max number of ids per $in query when getting the course structures
+structures_chunk_size = 500
+
+# Block types that define the structure of the course. All the rest are components.
+structural_types = frozenset(['course', 'chapter', 'sequential', 'vertical', 'library_content'])
+
+# Columns of the blocks table, in the order of the csv output.
+# Blocks are stored as one list per column (columnar layout) instead of one dict per
+# block: for deployments with millions of blocks this saves the per-block dict overhead.
+block_columns = (
+    'module_location',
+    'course_id',
+    'organization',
+    'course_code',
+    'course_edition',
+    'parent',
+    'block_type',
+    'block_id',
+    'display_name',
+    'course',
+    'chapter',
+    'sequential',
+    'vertical',
+    'library_content',
+    'component_name',
+    'weight',
+)
+
+# Column names as they appear in the datalake table and in the csv header. They differ
+# from some block columns (e.g. course_name vs course). Built once at module load; the
+# schema is fixed so there is no need to rebuild the field list per call.
+datalake_field_names = (
+    'module_location',
+    'course_id',
+    'organization',
+    'course_code',
+    'course_edition',
+    'parent',
+    'block_type',
+    'block_id',
+    'display_name',
+    'course_name',
+    'chapter',
+    'sequential',
+    'vertical',
+    'library',
+    'component',
+    'weight',
+)
+
+datalake_fields = [{"name": f, "type": "varchar"} for f in datalake_field_names]
 
 
 class CourseStructuresDatasource:
@@ -32,9 +87,11 @@ class CourseStructuresDatasource:
         mongodb_host = datasource_settings.get('mongodb_host', '127.0.0.1')
         self.mongodb_database = datasource_settings.get('mongodb_database', 'edxapp')
 
-        # Create a connection using MongoClient. 
-        log.debug("Connecting to mongo. Host: {} username: {} password: {}, db: {}".format(
-            mongodb_host, mongodb_username, mongodb_password, self.mongodb_database))
+        # Create a connection using MongoClient.
+        # Lazy %-style arguments defer the formatting until debug is enabled, and the
+        # password is never logged.
+        log.debug("Connecting to mongo. Host: %s username: %s db: %s",
+                  mongodb_host, mongodb_username, self.mongodb_database)
 
         try:
             self.client = MongoClient(
@@ -60,8 +117,8 @@ class CourseStructuresDatasource:
             mysql_host = datasource_settings.get('mysql_host', '127.0.0.1')
             mysql_database = datasource_settings.get('mysql_database', 'edxapp')
 
-            log.debug(f"Connecting MySQL: host: {mysql_host}:{mysql_port}, db: {mysql_database}, "
-                      f"user: {mysql_username} password: {mysql_password}")
+            log.debug("Connecting MySQL: host: %s:%s, db: %s, user: %s",
+                      mysql_host, mysql_port, mysql_database, mysql_username)
 
             try:
                 conn = pymysql.connect(
@@ -71,7 +128,9 @@ class CourseStructuresDatasource:
                     passwd=mysql_password,
                     db=mysql_database
                 )
-                self.cur = conn.cursor()
+                # Unbuffered cursor: the course index is only ever streamed row by row,
+                # so there is no need to hold the full result set in memory
+                self.cur = conn.cursor(pymysql.cursors.SSCursor)
 
             except pymysql.err.OperationalError as e:
                 log.error(e)
@@ -117,28 +176,7 @@ class CourseStructuresDatasource:
         :return: list[str] of fields
         """
 
-        fields = [
-            'module_location',
-            'course_id',
-            'organization',
-            'course_code',
-            'course_edition',
-            'parent',
-            'block_type',
-            'block_id',
-            'display_name',
-            'course_name',
-            'chapter',
-            'sequential',
-            'vertical',
-            'library',
-            'component',
-            'weight'
-        ]
-
-        fields_and_types = [{"name": f, "type": "varchar"} for f in fields]
-
-        return fields_and_types
+        return datalake_fields
 
     def get_structures(self, active_versions: dict) -> dict:
         """
@@ -149,12 +187,32 @@ class CourseStructuresDatasource:
         """
         published_branches = [active_version['published_branch'] for _, active_version in active_versions.items()]
         log.debug(published_branches)
-        log.debug("Getting blocks of {} published branches".format(len(published_branches)))
-        cursor = self.mongodb.modulestore.structures.find({'_id': {'$in': published_branches}})
+        log.debug("Getting blocks of %s published branches", len(published_branches))
+        # Project only the block fields used by get_blocks to cut the BSON payload,
+        # and raise the batch size to reduce getMore roundtrips on these large documents.
+        projection = {
+            'blocks.block_id': 1,
+            'blocks.block_type': 1,
+            'blocks.definition': 1,
+            'blocks.fields.display_name': 1,
+            'blocks.fields.children': 1,
+            'blocks.fields.weight': 1,
+        }
 
         structs = dict()
-        for record in cursor:
-            structs[record['_id']] = record
+
+        # Query the ids in chunks: with thousands of courses a single $in array makes a
+        # very large command document that MongoDB has to parse and scan per candidate.
+        for i in range(0, len(published_branches), structures_chunk_size):
+            chunk = published_branches[i:i + structures_chunk_size]
+            # Hint the _id index explicitly so large $in lists never fall back to a
+            # collection scan of these multi-MB documents
+            cursor = self.mongodb.modulestore.structures.find(
+                {'_id': {'$in': chunk}}, projection).hint([('_id', 1)]).batch_size(200)
+
+            for record in cursor:
+                structs[record['_id']] = record
+
         return structs
 
     def get_active_versions_mongodb(self):
@@ -171,7 +229,12 @@ class CourseStructuresDatasource:
         log.debug("Getting active versions")
 
         # Filter records without published-branch. This avoids loading e.g. libraries.
-        cursor = self.mongodb.modulestore.active_versions.find({'versions.published-branch': {'$exists': True}})
+        # Only the course id fields and the published branch are used, so project them
+        # and raise the batch size: these documents are small.
+        cursor = self.mongodb.modulestore.active_versions.find(
+            {'versions.published-branch': {'$exists': True}},
+            {'org': 1, 'course': 1, 'run': 1, 'versions.published-branch': 1},
+        ).batch_size(1000)
 
         active_versions = dict()
 
@@ -193,9 +256,73 @@ class CourseStructuresDatasource:
             log.error("Error accessing MongoDB: {}".format(e))
             return None
 
-        log.info("{} active versions found".format(len(active_versions)))
+        log.info("%s active versions found", len(active_versions))
         return active_versions
 
+    def get_active_versions_and_structures(self):
+        """
+        Returns the active versions and their course structures in one aggregation, joining
+        active_versions with structures server-side with a $lookup instead of fetching both
+        collections and joining them in Python.
+        Only available when the active versions live in MongoDB; with split mongo the active
+        versions come from MySQL and the two-step path is used instead.
+
+        :return: tuple of (active versions dict as in get_active_versions_mongodb,
+            structures dict as in get_structures)
+        """
+
+        log.debug("Getting active versions and structures")
+
+        pipeline = [
+            # Filter records without published-branch. This avoids loading e.g. libraries.
+            {'$match': {'versions.published-branch': {'$exists': True}}},
+            {'$lookup': {
+                'from': 'structures',
+                'localField': 'versions.published-branch',
+                'foreignField': '_id',
+                'as': 'structure',
+            }},
+            {'$unwind': '$structure'},
+            # Same field reduction as the separate queries: course id info plus the
+            # block fields used by get_blocks. The published branch is flattened to a
+            # top-level field so the loop below reads it with one lookup.
+            {'$project': {
+                'org': 1,
+                'course': 1,
+                'run': 1,
+                'published_branch': '$versions.published-branch',
+                'structure.blocks.block_id': 1,
+                'structure.blocks.block_type': 1,
+                'structure.blocks.definition': 1,
+                'structure.blocks.fields.display_name': 1,
+                'structure.blocks.fields.children': 1,
+                'structure.blocks.fields.weight': 1,
+            }},
+        ]
+
+        active_versions = dict()
+        structs = dict()
+
+        try:
+            cursor = self.mongodb.modulestore.active_versions.aggregate(pipeline, batchSize=200)
+            for record in cursor:
+                published_branch = record['published_branch']
+                course_id = f"course-v1:{record['org']}+{record['course']}+{record['run']}"
+
+                active_versions[course_id] = {
+                    'published_branch': published_branch,
+                    'org': record['org'],
+                    'course': record['course'],
+                    'run': record['run']
+                }
+                structs[published_branch] = record['structure']
+        except pymongo.errors.OperationFailure as e:
+            log.error("Error accessing MongoDB: {}".format(e))
+            return None, None
+
+        log.info("%s active versions found", len(active_versions))
+        return active_versions, structs
+
     def get_active_versions(self):
         """
         Returns a dict of courses in the active_versions collection in the form:
@@ -229,92 +356,104 @@ class CourseStructuresDatasource:
         ]
 
         log.debug("Getting active versions from mysql")
-        query = 'select {fields} from {table}'.format(
+        # Filter empty published versions server-side so only publishable courses travel
+        query = "select {fields} from {table} where published_version is not null and published_version != ''".format(
             fields=",".join(field_list),
-            table='split_modulestore_django_splitmodulestorecourseindex;',
+            table='split_modulestore_django_splitmodulestorecourseindex',
         )
 
-        log.debug("Querying mysql rows: {}".format(query))
+        log.debug("Querying mysql rows: %s", query)
 
         self.cur.execute(query)
-        rows = self.cur.fetchall()
 
         active_versions = dict()
+        object_id = bson.objectid.ObjectId
 
-        for record in rows:
+        # Iterate the unbuffered cursor directly instead of fetchall(), so rows stream
+        # from the server without materializing the whole table in memory first
+        for record in self.cur:
 
             course_id = record[1]
             if course_id[:6] == 'course':
-                # We only care about courses, not libraries
-                if record[0]:
-                    # make sure that the published version id is not empty
-                    published_branch = bson.objectid.ObjectId(record[0])
-
-                    active_versions[course_id] = {
-                        'published_branch': published_branch,
-                        'org': course_id[10:].split('+')[0],
-                        'course': course_id.split('+')[1],
-                        'run': course_id.split('+')[2]
-                    }
-
-        log.info("{} active versions found".format(len(active_versions)))
+                # We only care about courses, not libraries.
+                # One split covers the three course id parts; 10 skips the 'course-v1:' prefix
+                org, course, run = course_id[10:].split('+', 2)
+
+                active_versions[course_id] = {
+                    'published_branch': object_id(record[0]),
+                    'org': org,
+                    'course': course,
+                    'run': run
+                }
+
+        log.info("%s active versions found", len(active_versions))
         return active_versions
 
     def get_blocks(self, course_structures: dict, active_versions: dict) -> dict:
         """
-        Extracts the blocks of a course structure, in the form:
-        { block_id: {
-            'course_block_id': id of course in the structures' dict.
-                Use as index in the active_versions to get course info,
-            'block_type': block_type,
-            'display_name': display_name,
-            'children': children
-            },
-            ...
-        }
+        Extracts the blocks of all the course structures in columnar form: one list per
+        column of block_columns, all of the same length, one entry per block.
+        The n-th entry of each list belongs to the same block, so the csv rows are just
+        zip() of the lists.
+
         :param active_versions: course information from get_active_versions
         :param course_structures: list of course structure obtained from the get_structures function
-        :return: dict of blocks
+        :return: dict of column name to list of values, with one entry per block
         """
 
-        log.debug("Getting blocks for {} active versions".format(len(active_versions)))
+        log.debug("Getting blocks for %s active versions", len(active_versions))
+
+        cols = {name: [] for name in block_columns}
 
-        blocks = dict()
+        # Index of each block in the column lists, and the children of each block,
+        # kept out of cols because they are not exported
+        idx_of = dict()
+        children_col = []
 
         # Course structures is a list with one item per course, with the structure of the current active version.
         # There should be one and only one item in active_versions for each one in course_structures
         for course_id, active_version in active_versions.items():
-            log.debug(f"Getting blocks of course {course_id}")
+            # Lazy %s formatting: the logger only renders the message when debug is enabled
+            log.debug("Getting blocks of course %s", course_id)
             course_block_id = active_version['published_branch']
             structure = course_structures.get(course_block_id)
-            log.debug(f"Active branch of course {course_id} is {str(course_block_id)}")
+            log.debug("Active branch of course %s is %s", course_id, course_block_id)
 
             if not structure:
                 log.error(f"No course structure found for published branch {course_block_id} of course {course_id}")
                 continue
 
-            # The active_version dict only has information of the course id. This info is not in the structure element
-            organization = active_version.get('org')
-            course_code = active_version.get('course')
-            course_edition = active_version.get('run')
+            # The active_version dict only has information of the course id. This info is not in the structure element.
+            # These values repeat across courses (the same org decodes to a fresh string
+            # object per course document), so intern them to share one object per value.
+            organization = intern(active_version.get('org'))
+            course_code = intern(active_version.get('course'))
+            course_edition = intern(active_version.get('run'))
+
+            # Module location of each (block_type, block_id) pair of this course, so fill_tree
+            # resolves each child with a dict lookup instead of formatting its location again
+            loc_of = dict()
 
             # The course structure dict has an element 'blocks' with the internal structure of the course
             for block in structure.get('blocks'):
                 block_id = block.get('block_id')
-                block_type = block.get('block_type')
+                # Every block carries its own copy of the type string from the BSON
+                # decode; interning leaves one shared object per block type
+                block_type = intern(block.get('block_type'))
 
                 # One and only one item in the blocks list is the root of the course structure tree
                 if block_type == 'course':
                     module_location = course_id
                 else:
-                    module_location = 'block-v1:{}+{}+{}+type@{}+block@{}'.format(
-                        organization, course_code, course_edition, block_type, block_id
-                    )
+                    module_location = \
+                        f'block-v1:{organization}+{course_code}+{course_edition}+type@{block_type}+block@{block_id}'
 
-                # The display name of the block and the list of children is inside a dict called 'fields'
+                # The display name of the block and the list of children is inside a dict called 'fields'.
+                # children is normalized to an empty tuple so consumers can iterate or call len()
+                # without checking for None first.
                 fields = block.get('fields')
                 display_name = fields.get('display_name')
-                children = fields.get('children')
+                children = fields.get('children') or ()
 
                 # We get the weight of graded problems, which is optional
                 if block_type == 'problem':
@@ -354,84 +493,98 @@ class CourseStructuresDatasource:
                     # Other blocks than problem don't have a weight
                     weight = ''
 
-                # We build a dict for each component of the course with all the information
-                # that will be exported as a table
-
-                log.debug("Creating block {} with name {} and {} children".format(
-                    module_location, display_name, len(children) if children else 0))
-                blocks[module_location] = dict(
-                    organization=organization,
-                    course_code=course_code,
-                    course_edition=course_edition,
-                    course_id=course_id,
-                    block_type=block_type,
-                    block_id=block_id,
-                    display_name=display_name,
-                    children=children,
-                    weight=weight
-                )
+                # We append one entry per column for each block of the course.
+                # The columns filled by fill_tree (parent, structure names, component_name)
+                # start as None.
+                # No debug log here: this loop runs once per block and formatting the
+                # message dominates the iteration even with debug logging disabled.
+                idx_of[module_location] = len(children_col)
+                loc_of[(block_type, block_id)] = module_location
+                children_col.append(children)
+                cols['module_location'].append(module_location)
+                cols['course_id'].append(course_id)
+                cols['organization'].append(organization)
+                cols['course_code'].append(course_code)
+                cols['course_edition'].append(course_edition)
+                cols['parent'].append(None)
+                cols['block_type'].append(block_type)
+                cols['block_id'].append(block_id)
+                cols['display_name'].append(display_name)
+                cols['course'].append(None)
+                cols['chapter'].append(None)
+                cols['sequential'].append(None)
+                cols['vertical'].append(None)
+                cols['library_content'].append(None)
+                cols['component_name'].append(None)
+                cols['weight'].append(weight)
 
             # After checking all the blocks, there should be one for the course root
-            if course_id not in blocks:
+            if course_id not in idx_of:
                 log.error("No course block found in course {}".format(course_block_id))
             else:
                 # Starting with the root block of the course, we fill the tree with the parent branch information
-                self.fill_parents(blocks=blocks, block_id=course_id)
+                self.fill_tree(cols=cols, idx_of=idx_of, children_col=children_col, loc_of=loc_of,
+                               root_id=course_id)
 
-        log.info("{} blocks found".format(len(blocks)))
+        log.info("%s blocks found", len(children_col))
 
-        return blocks
+        return cols
 
-    def fill_parents(self, blocks: dict, block_id: str, parent_block_id: str = None) -> None:
+    def fill_tree(self, cols: dict, idx_of: dict, children_col: list, loc_of: dict, root_id: str) -> None:
         """
-        Fills with the parents a block and calls itself recursively on each child
-        :param parent_block_id:
-        :param block_id:
-        :param blocks:
+        Fills each block of the course tree with its parent id and the display names of the
+        structures it belongs to (course, chapter, sequential, vertical, library_content).
+        Iterative BFS from the course root, so deep courses don't hit the recursion limit.
+        :param cols: columnar block data, as built by get_blocks
+        :param idx_of: index of each module location in the column lists
+        :param children_col: children of each block, indexed like the column lists
+        :param loc_of: module location of each (block_type, block_id) pair of this course
+        :param root_id: id of the course root block
         :return:
         """
 
-        log.debug("Filling parents of {}".format(block_id))
+        log.debug("Filling tree of %s", root_id)
 
-        block = blocks.get(block_id)
-        if not block:
-            log.error("No block id {} found".format(block_id))
-            return
+        # Each queued item carries the display names inherited from the ancestor structures,
+        # so there is no need to look back at the parent block when visiting a node.
+        queue = deque([(root_id, None, {})])
 
-        # Course blocks don't have a parent. All the rest do.
-        if parent_block_id:
-            parent_block = blocks.get(parent_block_id)
-            parent_block_type = parent_block.get('block_type')
-
-            block['parent'] = parent_block_id
-            block[parent_block_type] = parent_block.get('display_name')
-
-            log.debug("Parent id: {}".format(parent_block_id))
-            # Fills with the upper structures
-            for b_type in ['course', 'chapter', 'sequential', 'vertical', 'library_content']:
-                if b_type in parent_block:
-                    log.debug("Parent {}: {}".format(b_type, parent_block.get(b_type)))
-                    block[b_type] = parent_block.get(b_type)
-
-        children = block.get('children')
-
-        if children:
-            log.debug("{} children found".format(len(children)))
-            for child in children:
-                child_module_location = 'block-v1:{}+{}+{}+type@{}+block@{}'.format(
-                    block.get('organization'),
-                    block.get('course_code'),
-                    block.get('course_edition'),
-                    child[0],  # child block type
-                    child[1]  # child block id
-                )
-                self.fill_parents(blocks=blocks, block_id=child_module_location, parent_block_id=block_id)
-        else:
-            log.debug("No children found")
+        while queue:
+            block_id, parent_block_id, inherited = queue.popleft()
+
+            idx = idx_of.get(block_id)
+            if idx is None:
+                log.error("No block id {} found".format(block_id))
+                continue
+
+            # Course blocks don't have a parent. All the rest do.
+            if parent_block_id:
+                cols['parent'][idx] = parent_block_id
+                for col_name, display_name in inherited.items():
+                    cols[col_name][idx] = display_name
+
+            children = children_col[idx]
+            block_type = cols['block_type'][idx]
+
+            if children:
+                # Children inherit this block's display name if it's a structural block
+                if block_type in structural_types:
+                    inherited = dict(inherited)
+                    inherited[block_type] = cols['display_name'][idx]
+
+                for child in children:
+                    # child is a (block type, block id) pair. Its module location was
+                    # already formatted by get_blocks, so look it up instead of
+                    # rebuilding the string for every parent-child edge
+                    child_module_location = loc_of.get((child[0], child[1]))
+                    if child_module_location is None:
+                        log.error("No block {} found in course {}".format(child, root_id))
+                        continue
+                    queue.append((child_module_location, block_id, inherited))
 
             # If it is a component block, set the display name as component name
-            if block.get('block_type') not in ['course', 'chapter', 'sequential', 'vertical', 'library_content']:
-                block['component_name'] = block.get('display_name')
+            elif block_type not in structural_types:
+                cols['component_name'][idx] = cols['display_name'][idx]
 
     def extract_and_load(self, selected_tables: str = None, force: bool = False):
 
@@ -445,54 +598,46 @@ class CourseStructuresDatasource:
         if self.use_split_mongo_active_versions:
             log.info("Using split mongo to get active versions")
             active_versions = self.get_active_versions()
+            if not active_versions:
+                log.warning("No active versions found")
+                return
+
+            # Get the structures of all the active versions
+            structures = self.get_structures(active_versions)
         else:
             log.info("Using mongodb to get active versions")
-            active_versions = self.get_active_versions_mongodb()
-        if not active_versions:
-            log.warning("No active versions found")
-            return
-        log.debug("Found {} active versions".format(len(active_versions)))
+            # When the active versions are in MongoDB, they are joined with their
+            # structures server-side in a single aggregation
+            active_versions, structures = self.get_active_versions_and_structures()
+            if not active_versions:
+                log.warning("No active versions found")
+                return
 
-        # Get the structures of all the active versions
-        structures = self.get_structures(active_versions)
-        log.debug("Found {} structures".format(len(structures)))
+        log.debug("Found %s active versions", len(active_versions))
+        log.debug("Found %s structures", len(structures))
 
-        # Build a dict with one item per block, including courses, chapters, sequentials, verticals and components
-        blocks = self.get_blocks(course_structures=structures, active_versions=active_versions)
-        log.debug("{} blocks found".format(len(blocks)))
+        # Build the columnar block data, including courses, chapters, sequentials, verticals and components
+        cols = self.get_blocks(course_structures=structures, active_versions=active_versions)
+        log.debug("%s blocks found", len(cols['module_location']))
 
         # Save the blocks as a csv table
         log.debug("Writing to CSV")
 
-        fields = self.get_fields(table="course_structures")
-
-        with open(filename, 'w') as f:
+        # Write the gzipped csv into an in-memory buffer and upload it directly, instead of
+        # going through a temporary file on disk. At compression level 1 even large installs
+        # fit comfortably in memory, and the write-then-reread disk round trip is avoided.
+        buffer = io.BytesIO()
+        # Compress on the fly: level 1 shrinks the csv several times over at near
+        # disk-bound speed, and Athena reads gzipped csv natively
+        with gzip.open(buffer, 'wt', compresslevel=1) as f:
             csv_writer = csv.writer(f)
-            csv_writer.writerow([f.get('name') for f in fields])
-
-            for module_location, block_data in blocks.items():
-                row = [
-                    module_location,
-                    block_data.get('course_id'),
-                    block_data.get('organization'),
-                    block_data.get('course_code'),
-                    block_data.get('course_edition'),
-                    block_data.get('parent'),
-                    block_data.get('block_type'),
-                    block_data.get('block_id'),
-                    block_data.get('display_name'),
-                    block_data.get('course'),
-                    block_data.get('chapter'),
-                    block_data.get('sequential'),
-                    block_data.get('vertical'),
-                    block_data.get('library_content'),
-                    block_data.get('component_name'),
-                    block_data.get('weight'),
-                ]
-                csv_writer.writerow(row)
-
-        self.datalake.upload_table_from_file(filename=filename, table='course_structures', update_partitions=True)
-
-        os.remove(filename)
+            csv_writer.writerow(datalake_field_names)
+
+            # zip over the column lists assembles the rows in C, one per block
+            csv_writer.writerows(zip(*(cols[name] for name in block_columns)))
+
+        buffer.seek(0)
+        self.datalake.upload_table_from_fileobj(
+            fileobj=buffer, table='course_structures', key_filename=filename, update_partitions=True)
 
         log.debug("Process completed")
@@ -34,6 +34,9 @@ class CSVDatasource:
         self.location = datasource_settings.get('location')
         self.datalake = datalake
 
+        # Field lists already read from the file, keyed by table
+        self.fields_cache = {}
+
     def test_connections(self) -> dict:
         """
         Performs connections test
@@ -68,9 +71,14 @@ class CSVDatasource:
         if self.table_fields and self.table_fields.get(table) and not force_query:
             return self.table_fields.get(table)
 
+        # Return the cached list if the file was already read
+        if table in self.fields_cache and not force_query:
+            return self.fields_cache.get(table)
+
+        # csv.reader is lazy, so only the header record is read; it may span
+        # several lines if a quoted field name contains newlines
         with open(self.location, mode='r') as file:
-            csv_file = csv.reader(file)
-            fields = next(csv_file)
+            fields = next(csv.reader(file))
 
         log.debug("Fields in table: {}".format(fields))
 
@@ -78,6 +86,8 @@ class CSVDatasource:
         for field in fields:
             fields_list.append({"name": field, "type": 'string'})
 
+        self.fields_cache[table] = fields_list
+
         return fields_list
 
     def extract_and_load(self, selected_tables: str = None, force: bool = False):
@@ -5,14 +5,91 @@ Data can be partitioned by a list of base partitions and a set of fields.
 
 """
 import datetime
+import gzip
 import os
 import csv
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
 
 import pymysql
+from pymysql.constants import FIELD_TYPE
 
 from panorama_elt.panorama_datalake.panorama_datalake import PanoramaDatalake
 from panorama_elt.panorama_logger.setup_logger import log
 
+# Translation table to escape backslashes, newlines and CR characters in one C-level pass
+escapes = str.maketrans({'\\': '\\\\', '\r': '\\r', '\n': '\\n'})
+
+# Mysql column type codes that decode to str and may need escaping
+string_type_codes = frozenset([
+    FIELD_TYPE.VARCHAR, FIELD_TYPE.VAR_STRING, FIELD_TYPE.STRING, FIELD_TYPE.ENUM, FIELD_TYPE.SET,
+    FIELD_TYPE.BLOB, FIELD_TYPE.TINY_BLOB, FIELD_TYPE.MEDIUM_BLOB, FIELD_TYPE.LONG_BLOB, FIELD_TYPE.JSON,
+])
+
+# Mysql column type codes that decode to datetime.datetime
+datetime_type_codes = frozenset([FIELD_TYPE.DATETIME, FIELD_TYPE.TIMESTAMP])
+
+# Number of partitions extracted and uploaded concurrently
+max_workers = 8
+
+# Directory for the intermediate csv files before upload. A RAM-backed directory
+# like /dev/shm avoids touching disk, but large extracts can exhaust it, so it is
+# only used when explicitly requested via the PANORAMA_TMP environment variable.
+tmp_dir = os.environ.get('PANORAMA_TMP') or tempfile.gettempdir()
+
+
+def escape_rows(rows: iter) -> iter:
+    """
+    Generator that yields each row with string fields escaped and datetimes formatted,
+    so rows are transformed on the fly instead of being materialized in memory.
+
+    :param rows: result of a query execution
+    :return: generator of escaped rows
+    """
+
+    # When rows is a cursor, its description tells which columns are strings or datetimes,
+    # so only those cells are visited instead of type-checking every cell of every row.
+    description = getattr(rows, 'description', None)
+    if description is not None:
+        str_idx = [i for i, d in enumerate(description) if d[1] in string_type_codes]
+        dt_idx = [i for i, d in enumerate(description) if d[1] in datetime_type_codes]
+
+        # All-numeric tables need no escaping at all: pass the rows through untouched
+        # and let the csv writer consume the cursor directly
+        if not str_idx and not dt_idx:
+            yield from rows
+            return
+
+        for row in rows:
+            row = list(row)
+            for i in str_idx:
+                field = row[i]
+                if type(field) is str:
+                    row[i] = field.translate(escapes)
+            for i in dt_idx:
+                field = row[i]
+                # pymysql returns unparseable values (e.g. zero dates) of datetime
+                # columns as str, so the type must be checked even here
+                if isinstance(field, datetime.datetime):
+                    # %f always emits the 6-digit microseconds, even when they are zero
+                    row[i] = field.strftime('%Y-%m-%d %H:%M:%S.%f')
+                elif type(field) is str:
+                    row[i] = field.translate(escapes)
+            yield row
+        return
+
+    for row in rows:
+        fields_list = []
+        for field in row:
+            if type(field) is str:
+                field = field.translate(escapes)
+            elif isinstance(field, datetime.datetime):
+                # %f always emits the 6-digit microseconds, even when they are zero
+                field = field.strftime('%Y-%m-%d %H:%M:%S.%f')
+            fields_list.append(field)
+        yield fields_list
+
 
 def save_rows(filename: str, fields: list, rows: iter) -> None:
     """
@@ -24,7 +101,7 @@ def save_rows(filename: str, fields: list, rows: iter) -> None:
     :return: None
     """
 
-    log.debug("Saving {}".format(filename))
+    log.debug("Saving %s", filename)
 
     # As some fields may include double quotes, we need to set the csv writer to
     # use backslash as escape char and not double, double quotes.
@@ -32,28 +109,20 @@ def save_rows(filename: str, fields: list, rows: iter) -> None:
     # have escaped chars. There is a bug in csv writer by which it will not
     # escape preexistent escape chars (see https://bugs.python.org/issue12178)
     # This should be fixed by python 3.10. To keep compatibility with previous
-    # versions, we unpack all the data and escape backslashes in all strings.
-    # In python 3.10, the next block can be removed and use
-    # write.writerows(rows) directly
-    rows_list = []
-    for row in rows:
-        fields_list = []
-        for field in row:
-            if type(field) is str:
-                field = field.replace('\\', '\\\\')
-                # Escape newline and CR characters
-                field = field.replace('\r', '\\r') 
-                field = field.replace('\n', '\\n') 
-            elif isinstance(field, datetime.datetime):
-                # When the seconds are zero, the microseconds are not displayed
-                field = field.strftime('%Y-%m-%d %H:%M:%S.') + '%06d' % field.microsecond
-            fields_list.append(field)
-        rows_list.append(fields_list)
-
-    with open(filename, 'w') as f:
+    # versions, we escape backslashes in all strings while streaming the rows
+    # through the escape_rows generator.
+    # Compress on the fly when the target is a .gz file. Level 1 shrinks tabular text
+    # several times over at near disk-bound speed, and Athena reads gzipped csv natively.
+    if filename.endswith('.gz'):
+        out = gzip.open(filename, 'wt', compresslevel=1)
+    else:
+        # A 1MB write buffer cuts the number of write syscalls on large tables
+        out = open(filename, 'w', buffering=1024 * 1024)
+
+    with out as f:
         write = csv.writer(f, doublequote=False, escapechar='\\')
         write.writerow(fields)
-        write.writerows(rows_list)
+        write.writerows(escape_rows(rows))
 
 
 class MySQLDatasource:
@@ -70,15 +139,22 @@ class MySQLDatasource:
         mysql_host = datasource_settings.get('mysql_host', '127.0.0.1')
         mysql_database = datasource_settings.get('mysql_database', 'edxapp')
 
+        # Kept to open extra connections for the partition extraction workers
+        self.connection_settings = {
+            'host': mysql_host,
+            'port': mysql_port,
+            'user': mysql_username,
+            'passwd': mysql_password,
+            'db': mysql_database,
+        }
+
         try:
-            conn = pymysql.connect(
-                host=mysql_host,
-                port=mysql_port,
-                user=mysql_username,
-                passwd=mysql_password,
-                db=mysql_database
-            )
+            conn = pymysql.connect(**self.connection_settings)
             self.cur = conn.cursor()
+            # Unbuffered (server-side) cursor to stream large row sets without
+            # materializing them in memory. Each result set must be fully
+            # consumed before running the next query on it.
+            self.ss_cur = conn.cursor(pymysql.cursors.SSCursor)
 
         except pymysql.err.OperationalError as e:
             log.error(e)
@@ -113,11 +189,11 @@ class MySQLDatasource:
         Performs connections test
         :return: dict with test results
         """
-        query = "SHOW DATABASES"
-        self.cur.execute(query)
-        r = self.cur.fetchall()
+        # Check the one schema we care about instead of materializing SHOW DATABASES
+        query = "select 1 from INFORMATION_SCHEMA.SCHEMATA where SCHEMA_NAME = %s"
+        self.cur.execute(query, (self.db,))
 
-        if self.db in [x[0] for x in r]:
+        if self.cur.fetchone():
             results = {'MySQL': 'OK'}
         else:
             results = {'MySQL': 'DB not found'}
@@ -128,8 +204,8 @@ class MySQLDatasource:
         Returns the list of tables available in the database
         :return: list of sheet names
         """
-        query = "SHOW TABLES"
-        self.cur.execute(query)
+        query = "select TABLE_NAME from INFORMATION_SCHEMA.TABLES where TABLE_SCHEMA = %s"
+        self.cur.execute(query, (self.db,))
         r = self.cur.fetchall()
 
         return [t[0] for t in r]
@@ -150,18 +226,16 @@ class MySQLDatasource:
         fields_query = """
             select COLUMN_NAME, DATA_TYPE
             from INFORMATION_SCHEMA.COLUMNS
-            WHERE TABLE_NAME = "{table}"
-            AND TABLE_SCHEMA = "{db}"
-            """.format(
-            table=table,
-            db=self.db)
+            WHERE TABLE_NAME = %s
+            AND TABLE_SCHEMA = %s
+            """
 
-        log.debug("Querying mysql fields: {}".format(fields_query))
+        log.debug("Querying mysql fields of table %s", table)
 
-        self.cur.execute(fields_query)
+        self.cur.execute(fields_query, (table, self.db))
         fields = self.cur.fetchall()
 
-        log.debug("Fields in table: {}".format(fields))
+        log.debug("Fields in table: %s", fields)
 
         fields_list = []
         for field in fields:
@@ -169,20 +243,53 @@ class MySQLDatasource:
 
         return fields_list
 
-    def get_rows(self, table: str, field_list: list = None,
-                 where: str = None, distinct: bool = False) -> iter:
+    def get_all_fields(self, tables: list) -> dict:
+        """
+        Returns the field lists of multiple tables in a single round trip to the database,
+        instead of one INFORMATION_SCHEMA query per table.
+
+        :param tables: list of table names
+        :return: dict mapping each table name to its list of fields
+        """
+
+        # An empty IN () list is a mysql syntax error
+        if not tables:
+            return {}
+
+        placeholders = ','.join(['%s'] * len(tables))
+        fields_query = """
+            select TABLE_NAME, COLUMN_NAME, DATA_TYPE
+            from INFORMATION_SCHEMA.COLUMNS
+            WHERE TABLE_NAME IN ({})
+            AND TABLE_SCHEMA = %s
+            ORDER BY TABLE_NAME, ORDINAL_POSITION
+            """.format(placeholders)
+
+        log.debug("Querying mysql fields of tables %s", tables)
+
+        self.cur.execute(fields_query, (*tables, self.db))
+
+        fields_by_table = {}
+        for table, column_name, data_type in self.cur.fetchall():
+            fields_by_table.setdefault(table, []).append({"name": column_name, "type": data_type})
+
+        return fields_by_table
+
+    def build_query(self, table: str, field_list: list = None,
+                    where: str = None, distinct: bool = False) -> str:
         """
-        Returns the rows of the mysql table.
+        Builds the select query for the mysql table.
 
         :param distinct: if true, only distinct values will be returned
         :param table: name of the table
         :param field_list: (optional) list of fields to query. If omitted, all fields will be retrieved
-        :param where: string to apply to the WHERE condition of the query, in mysql format
-        :return:
+        :param where: string to apply to the WHERE condition of the query, in mysql format.
+            May contain %s placeholders, to be bound when the query is executed.
+        :return: query string
         """
 
         if not field_list:
-            log.warning("No field list provided for table '{}'. Using '*' to query all mysql fields.".format(table))
+            log.warning("No field list provided for table '%s'. Using '*' to query all mysql fields.", table)
             fields_statement = '*'
         else:
 
@@ -209,19 +316,82 @@ class MySQLDatasource:
 
         where_clause = 'where {}'.format(where) if where else ''
 
-        query = 'select {prefix} {fields} from {table} {where_clause}'.format(
+        query = 'select {prefix} {fields} from `{table}` {where_clause}'.format(
             prefix='distinct' if distinct else '',
             fields=fields_statement,
             table=table,
             where_clause=where_clause)
 
-        log.debug("Querying mysql rows: {}".format(query))
+        return query
+
+    def get_rows(self, table: str, field_list: list = None,
+                 where: str = None, distinct: bool = False, params: tuple = None) -> iter:
+        """
+        Returns an iterator over the rows of the mysql table.
+        The query runs on the unbuffered cursor, so rows are fetched from the server as they
+        are consumed and the result must be fully iterated before issuing another query.
+
+        :param distinct: if true, only distinct values will be returned
+        :param table: name of the table
+        :param field_list: (optional) list of fields to query. If omitted, all fields will be retrieved
+        :param where: string to apply to the WHERE condition of the query, in mysql format
+        :param params: (optional) values to bind to the %s placeholders of the where condition
+        :return: iterator over the query results
+        """
+
+        query = self.build_query(table=table, field_list=field_list, where=where, distinct=distinct)
+
+        log.debug("Querying mysql rows: %s", query)
+
+        self.ss_cur.execute(query, params)
+
+        return self.ss_cur
 
-        self.cur.execute(query)
+    def _process_partition(self, table: str, fields: list, partition_fields: list, values: tuple) -> None:
+        """
+        Extracts one partition of the table and uploads it to the datalake.
+        Runs in a worker thread, so it opens its own mysql connection: connections are not
+        thread-safe and the shared unbuffered cursor can only serve one query at a time.
+
+        :param table: name of the table
+        :param fields: list of fields to extract
+        :param partition_fields: list of fields that define the partition
+        :param values: values of the partition fields for this partition
+        :return: None
+        """
+
+        # Create a filter to match all partition fields with the values with changes in the interval.
+        # The values are bound as query parameters: the query text stays constant across
+        # partitions (better server-side caching) and config-supplied values can't break the SQL.
+        where_clause = " and ".join("`{}` = %s".format(partition_field) for partition_field in partition_fields)
+
+        log.info("Getting partition of %s with %s", table, values)
+
+        query = self.build_query(table=table, field_list=fields, where=where_clause)
+
+        # Per-worker filename to avoid clashes between concurrent partitions
+        filename = os.path.join(tmp_dir, "{}-{}.csv.gz".format(table, uuid4().hex))
+
+        conn = pymysql.connect(**self.connection_settings)
+        try:
+            cur = conn.cursor(pymysql.cursors.SSCursor)
+            log.debug("Querying mysql rows: %s", query)
+            cur.execute(query, tuple(values))
+            save_rows(filename=filename, fields=fields, rows=cur)
+        finally:
+            conn.close()
 
-        rows = self.cur.fetchall()
+        field_partitions = {}
+        for k, v in zip(partition_fields, values):
+            field_partitions[k] = v
 
-        return rows
+        # Partitions are registered in bulk by extract_and_load after all uploads finish
+        self.datalake.upload_table_from_file(filename=filename, table=table,
+                                             field_partitions=field_partitions,
+                                             update_partitions=False,
+                                             key_filename="{}.csv.gz".format(table))
+
+        os.remove(filename)
 
     def extract_and_load(self, selected_tables: str = None, force: bool = False):
         """
@@ -231,16 +401,20 @@ class MySQLDatasource:
         :param force: Forces a full update of all the partitions
         :return:
         """
+        selected = frozenset(selected_tables.split(',')) if selected_tables else None
         for table in self.table_fields.keys():
 
-            if selected_tables and table not in selected_tables.split(','):
+            if selected and table not in selected:
                 continue
 
-            log.info("Extracting {}".format(table))
+            log.info("Extracting %s", table)
 
             fields = self.get_fields(table=table)
 
-            filename = "{}.csv".format(table)
+            key_filename = "{}.csv.gz".format(table)
+            # Unique local filename so datasources sharing a table name can't
+            # race on the same temp file; the S3 key keeps the stable name
+            filename = os.path.join(tmp_dir, "{}-{}.csv.gz".format(table, uuid4().hex))
 
             partitions = self.field_partitions.get(table)
             if partitions:
@@ -265,40 +439,38 @@ class MySQLDatasource:
                     else:
                         # interval will be used in a where clause to query all the partitions with changes
                         interval = "{} >= date_sub(now(), interval {})".format(timestamp_field, update_interval)
-                        log.debug("Doing incremental update of the last {}".format(update_interval))
-
-                # Get a list of all distinct partition field values in the recordset within the last increment period
-                values_list = self.get_rows(table=table, field_list=partition_fields, distinct=True, where=interval)
-                log.info("{} partitions found to update".format(len(values_list)))
-
-                # Now we need to make one query for each set of values representing partitions, with changes in the
-                # last period.
-                counter = 1
-                for values in values_list:
-
-                    # Create a filter to match all partition fields with the values with changes in the interval
-                    where_clauses = []
-                    for partition_field, value in zip(partition_fields, values):
-                        where_clauses.append("{} = '{}'".format(partition_field, value))
-                    where_clause = " and ".join(where_clauses)
+                        log.debug("Doing incremental update of the last %s", update_interval)
 
-                    log.info("Getting partition {}/{}".format(counter, len(values_list)))
-                    counter += 1
+                        # Cheap probe before scanning for partitions: if no row changed in the
+                        # interval, the distinct query and the partition loop can be skipped.
+                        self.cur.execute("select 1 from `{}` where {} limit 1".format(table, interval))
+                        if not self.cur.fetchall():
+                            log.info("No changes in %s in the last %s. Skipping.", table, update_interval)
+                            continue
 
-                    # Query mysql table
-                    rows = self.get_rows(table=table, field_list=fields, where=where_clause)
+                # Get a list of all distinct partition field values in the recordset within the last increment period.
+                # Materialized as a list to release the unbuffered cursor before the per-partition queries.
+                values_list = list(self.get_rows(table=table, field_list=partition_fields, distinct=True,
+                                                 where=interval))
+                log.info("%s partitions found to update", len(values_list))
 
-                    save_rows(filename=filename, fields=fields, rows=rows)
-
-                    field_partitions = {}
-                    for k, v in zip(partition_fields, values):
-                        field_partitions[k] = v
-
-                    self.datalake.upload_table_from_file(filename=filename, table=table,
-                                                         field_partitions=field_partitions,
-                                                         update_partitions=True)
-
-                    os.remove(filename)
+                # Now we need to make one query for each set of values representing partitions, with changes in the
+                # last period. Partitions are independent and the work is I/O bound on mysql and S3,
+                # so they are extracted and uploaded concurrently by a pool of workers.
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    futures = [
+                        executor.submit(self._process_partition, table, fields, partition_fields, values)
+                        for values in values_list
+                    ]
+                    for future in futures:
+                        future.result()
+
+                # All the updated partitions are registered in a single ALTER TABLE
+                # statement instead of one Athena execution per partition
+                self.datalake.update_partitions_bulk(
+                    table=table,
+                    field_partitions_list=[dict(zip(partition_fields, values)) for values in values_list]
+                )
 
             else:
 
@@ -306,6 +478,7 @@ class MySQLDatasource:
                 rows = self.get_rows(table=table, field_list=fields)
                 save_rows(filename=filename, fields=fields, rows=rows)
 
-                self.datalake.upload_table_from_file(filename=filename, table=table, update_partitions=True)
+                self.datalake.upload_table_from_file(filename=filename, table=table,
+                                                     update_partitions=True, key_filename=key_filename)
 
                 os.remove(filename)
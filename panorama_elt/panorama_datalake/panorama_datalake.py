@@ -1,24 +1,115 @@
 """
 Utility class to manage aws datalake for Panorama analytics
 """
+import hashlib
+import string
 import time
 import urllib.parse
+from collections import Counter, deque
+from functools import cached_property
 from uuid import uuid4
 
 import boto3
 import botocore
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 
 from panorama_elt.panorama_logger.setup_logger import log
 
+# Characters that never need url-quoting in a Hive partition fragment
+safe_chars = frozenset(string.ascii_letters + string.digits + '-._~')
+
+
+def partition_clause(partition_field: str, value: str) -> str:
+    """
+    SQL clause matching one partition field. Single quotes in the value are doubled,
+    so a quote inside a partition value cannot break out of the DDL literal.
+    """
+    escaped = value.replace("'", "''")
+    return f"{partition_field} = '{escaped}'"
+
+
+def quote_value(value: str) -> str:
+    """
+    Url-quote a partition value. Hostnames, course ids and dates are almost always
+    url-safe already, so the per-character quote loop is skipped for them.
+    """
+    if safe_chars.issuperset(value):
+        return value
+    return urllib.parse.quote(value)
+
+
+# View casts per mysql field type, resolved with one dict lookup per field
+# instead of a chain of membership tests
+numeric_casts = {
+    'INT': 'BIGINT', 'TINYINT': 'BIGINT', 'SMALLINT': 'BIGINT', 'MEDIUMINT': 'BIGINT', 'BIGINT': 'BIGINT',
+    'FLOAT': 'DOUBLE', 'DOUBLE': 'DOUBLE', 'DECIMAL': 'DOUBLE',
+}
+datetime_types = frozenset(['DATETIME', 'DATE', 'TIMESTAMP', 'TIME', 'YEAR'])
+# JSON is cast as a plain string because Hive views don't support it
+string_types = frozenset(['CHAR', 'VARCHAR', 'BLOB', 'TEXT', 'TINYBLOB', 'TINYTEXT', 'MEDIUMBLOB', 'MEDIUMTEXT',
+                          'LONGBLOB', 'LONGTEXT', 'ENUM', 'STRING', 'JSON'])
+
+# Athena rejects query strings over 262144 bytes, so bulk partition updates are
+# split in statements of at most this many partitions. Each fragment is a couple
+# hundred bytes, which leaves ample margin at this size.
+partitions_per_query = 500
+
+# Per-process nonce mixed into the Athena request tokens. Identical statements are
+# still deduplicated within one run, but a new run (e.g. the next cron invocation)
+# always starts fresh executions: otherwise a transiently FAILED execution would be
+# returned again for every rerun within Athena's 60-minute idempotency window.
+request_token_nonce = uuid4().hex
+
+# SQL templates, built once at module level instead of inside each call
+partitions_section_template = """
+                PARTITIONED BY (
+                    {partitions_definitions}
+                  )
+            """
+
+create_table_template = """
+            CREATE EXTERNAL TABLE IF NOT EXISTS `{datalake_table}`(
+                {fields_definitions}
+              )
+            {partitions_section}
+            ROW FORMAT SERDE
+              'org.apache.hadoop.hive.serde2.OpenCSVSerde'
+            WITH SERDEPROPERTIES (
+              'escapeChar'='\\\\',
+              'quoteChar'='\\"',
+              'separatorChar'=',')
+            STORED AS INPUTFORMAT
+              'org.apache.hadoop.mapred.TextInputFormat'
+            OUTPUTFORMAT
+              'org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat'
+            LOCATION
+              '{location}'
+            TBLPROPERTIES (
+              'areColumnsQuoted'='false',
+              'classification'='csv',
+              'columnsOrdered'='true',
+              'compressionType'='none',
+              'delimiter'=',',
+              'skip.header.line.count'='1',
+              'typeOfData'='file')
+        """
+
+create_view_template = """CREATE OR REPLACE VIEW "{view_name}" AS
+        SELECT {fields_definition}
+        FROM "{database}"."{table_name}"
+        """
+
 
 class PanoramaDatalake:
 
-    def __init__(self, datalake_settings: dict):
+    def __init__(self, datalake_settings: dict, session: boto3.Session = None):
         """
         Connection to Panorama AWS datalake
 
         :param datalake_settings: dict with datalake settings
+        :param session: (optional) boto3 session to reuse. If omitted, one is created
+            from the aws credentials in the settings
         """
 
         self.datalake_settings = datalake_settings
@@ -35,13 +126,27 @@ class PanoramaDatalake:
             for base_partition in datalake_settings.get('base_partitions'):
                 self.base_partitions[base_partition.get('name')] = base_partition.get('value')
 
+        # The base partitions are the same for every upload, so the SQL clauses and the
+        # url-quoted Hive fragments are built once here instead of on each call.
+        self.base_partitions_clauses = [
+            partition_clause(partition_field, value) for partition_field, value in self.base_partitions.items()
+        ]
+        self.base_partitions_uri = [
+            f"{partition_field}={quote_value(value)}"
+            for partition_field, value in self.base_partitions.items()
+        ]
+
         # Base prefix (initial folder) for all datalake files
         self.base_prefix = datalake_settings.get('base_prefix')
 
-        # List of athena executions to track
-        self.executions = []
+        # Executions still being tracked; finished ones are drained into a counter by
+        # get_athena_executions, so memory stays bounded in long-lived processes
+        self.executions = deque()
+        self.completed_executions = Counter()
 
-        if datalake_settings.get('aws_access_key'):
+        if session:
+            log.debug("Reusing boto3 session")
+        elif datalake_settings.get('aws_access_key'):
             log.debug("Creating boto3 session with access key {}".format(datalake_settings.get('aws_access_key')))
             session = boto3.Session(
                 aws_access_key_id=datalake_settings.get('aws_access_key'),
@@ -52,40 +157,85 @@ class PanoramaDatalake:
             log.debug("Creating boto3 session without access key")
             session = boto3.Session(region_name=datalake_settings.get('aws_region', 'us-east-1'))
 
-        self.s3_client = session.client('s3')
-        self.athena = session.client('athena', region_name=datalake_settings.get('aws_region', 'us-east-1'))
+        # Keep connections alive and size the pool for the concurrent uploads and Athena
+        # submissions, so parallel callers don't queue on the client's connection pool.
+        # The clients themselves are created lazily by the properties below.
+        self._session = session
+        self._aws_region = datalake_settings.get('aws_region', 'us-east-1')
+        self._client_config = botocore.config.Config(
+            max_pool_connections=max(32, int(datalake_settings.get('upload_max_concurrency', 16))),
+            retries={'mode': 'adaptive'},
+            tcp_keepalive=True,
+        )
+
+        # Upload large files in parallel multipart chunks to make better use of the bandwidth.
+        # The chunk size (in MB) and the number of concurrent threads can be tuned in the
+        # datalake settings for deployments with fat pipes.
+        multipart_chunksize = int(datalake_settings.get('multipart_chunksize_mb', 64)) * 1024 * 1024
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_chunksize,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=int(datalake_settings.get('upload_max_concurrency', 16)),
+            use_threads=True
+        )
 
         self.datalake_db = datalake_settings.get('datalake_database')
         self.datalake_workgroup = datalake_settings.get('datalake_workgroup')
 
-    def test_connections(self) -> dict:
+    @cached_property
+    def s3_client(self):
+        """
+        S3 client, created on first use so runs that never touch S3 skip the
+        endpoint and credential resolution.
+        """
+        return self._session.client('s3', config=self._client_config)
+
+    @cached_property
+    def athena(self):
+        """
+        Athena client, created on first use.
+        """
+        return self._session.client('athena', region_name=self._aws_region, config=self._client_config)
+
+    def test_connections(self, verify_write: bool = False) -> dict:
         """
         Performs connections test
+        :param verify_write: if set to True, also verifies write access by putting and
+            deleting a test object. By default only bucket access is checked, which is a
+            single lightweight request instead of two billed writes.
         :return: dict with test results
         """
         results = {}
 
-        # Test upload to s3
+        # Test access to s3
 
         try:
-            log.debug("Putting object PanoramaConnectionTest in bucket {}".format(self.panorama_raw_data_bucket))
-            result1 = self.s3_client.put_object(Bucket=self.panorama_raw_data_bucket, Key='PanoramaConnectionTest')
-            log.debug("Deletting object PanoramaConnectionTest in bucket {}".format(self.panorama_raw_data_bucket))
-            result2 = self.s3_client.delete_object(Bucket=self.panorama_raw_data_bucket, Key='PanoramaConnectionTest')
-            if result1 and result2:
-                results['S3'] = 'OK'
+            log.debug("Checking access to bucket {}".format(self.panorama_raw_data_bucket))
+            self.s3_client.head_bucket(Bucket=self.panorama_raw_data_bucket)
+
+            if verify_write:
+                log.debug("Putting object PanoramaConnectionTest in bucket {}".format(self.panorama_raw_data_bucket))
+                self.s3_client.put_object(Bucket=self.panorama_raw_data_bucket, Key='PanoramaConnectionTest')
+                log.debug("Deletting object PanoramaConnectionTest in bucket {}".format(self.panorama_raw_data_bucket))
+                self.s3_client.delete_object(Bucket=self.panorama_raw_data_bucket, Key='PanoramaConnectionTest')
+
+            results['S3'] = 'OK'
 
         except botocore.exceptions.ClientError as e:
             results['S3'] = e.response.get('Error')
 
-        # Test Athena
+        # Test Athena. The database listing changes rarely, so a cached result of a
+        # recent identical run is good enough and saves the scan.
         query = "SHOW DATABASES"
-        self.query_athena(query)
+        self.query_athena(query, reuse_max_age=60)
+        # The execution is drained from the tracking queue once it finishes, so its id
+        # is captured before polling
+        execution_id = self.executions[-1].get('QueryExecutionId') if self.executions else None
         result = self.get_athena_executions()
 
         if 'SUCCEEDED' in result and result.get('SUCCEEDED') == 1:
             try:
-                r = self.athena.get_query_results(QueryExecutionId=self.executions[0]['QueryExecutionId'])
+                r = self.athena.get_query_results(QueryExecutionId=execution_id)
 
                 rows = [row.get('Data') for row in r['ResultSet']['Rows']]
 
@@ -103,10 +253,15 @@ class PanoramaDatalake:
 
         return results
 
-    def query_athena(self, query: str) -> None:
+    def query_athena(self, query: str, reuse_max_age: int = None, force_new: bool = False) -> None:
         """
         Sends a query to Athena and waits for a response
         :param query: SQL query
+        :param reuse_max_age: (optional) reuse cached results of an identical query up to this
+            many minutes old. Athena only honors the hint where result reuse applies; passing
+            it on other statements is harmless.
+        :param force_new: (optional) if set to True, always start a distinct execution even if
+            an identical query was already submitted in this run.
         :return: None
         """
 
@@ -114,8 +269,21 @@ class PanoramaDatalake:
             log.warning("Datalake db or workgroup not configured. Skipping datalake update.")
             return
 
-        crt = str(uuid4())
+        if force_new:
+            crt = str(uuid4())
+        else:
+            # Deriving the request token from the query makes resubmissions of the same
+            # idempotent DDL within this run reuse the first execution instead of
+            # starting a new billed one; the nonce keeps reuse scoped to the process
+            crt = hashlib.sha256((request_token_nonce + query).encode()).hexdigest()
         log.debug("Executing {}".format(query))
+
+        kwargs = {}
+        if reuse_max_age:
+            kwargs['ResultReuseConfiguration'] = {
+                'ResultReuseByAgeConfiguration': {'Enabled': True, 'MaxAgeInMinutes': reuse_max_age}
+            }
+
         try:
             execution = self.athena.start_query_execution(
                 QueryString=query,
@@ -123,7 +291,8 @@ class PanoramaDatalake:
                 QueryExecutionContext={
                     'Database': self.datalake_db
                 },
-                WorkGroup=self.datalake_workgroup
+                WorkGroup=self.datalake_workgroup,
+                **kwargs
             )
             self.executions.append(execution)
 
@@ -149,22 +318,94 @@ class PanoramaDatalake:
         Show the results of all athena executions
         :return: None
         """
-        results = {}
+        # Last known state of each execution, updated until it becomes terminal
+        states = {execution.get('QueryExecutionId'): None for execution in self.executions}
+        pending = list(states)
+        # The wait between polls backs off exponentially, so short DDL queries are caught
+        # within milliseconds while long-running ones don't burn the API request quota.
+        delay = 0.05
         i = max_iter
-        while ('RUNNING' in results or 'QUEUED' in results or i == max_iter) and i > 0:
-            results = {}
+        while pending and i > 0:
             i -= 1
-            for execution in self.executions:
-                result = self.get_athena_query_execution(execution)
-                if result not in results:
-                    results[result] = 1
-                else:
-                    results[result] += 1
-            time.sleep(1)
+            still_pending = []
+            # batch_get_query_execution resolves up to 50 executions per roundtrip, and
+            # executions that already reached a terminal state are not polled again
+            for start in range(0, len(pending), 50):
+                try:
+                    response = self.athena.batch_get_query_execution(QueryExecutionIds=pending[start:start + 50])
+                    query_executions = response.get('QueryExecutions')
+                except ClientError as e:
+                    # Policies predating athena:BatchGetQueryExecution may only grant the
+                    # per-execution action: degrade to one call per execution instead of aborting
+                    log.debug("batch_get_query_execution failed (%s), polling executions one by one", e)
+                    try:
+                        query_executions = [
+                            self.athena.get_query_execution(QueryExecutionId=execution_id).get('QueryExecution')
+                            for execution_id in pending[start:start + 50]
+                        ]
+                    except ClientError as e:
+                        log.error(e)
+                        exit(1)
+
+                for query_execution in query_executions:
+                    execution_id = query_execution.get('QueryExecutionId')
+                    state = query_execution.get('Status').get('State')
+                    states[execution_id] = state
+                    if state in ('RUNNING', 'QUEUED'):
+                        still_pending.append(execution_id)
+
+            if len(still_pending) < len(pending):
+                # Progress was made: poll again quickly, more executions may be about to finish
+                delay = 0.05
+            pending = still_pending
+            log.debug("Summary of athena executions: {}".format(dict(Counter(states.values()))))
+            if pending:
+                time.sleep(delay)
+                delay = min(delay * 1.5, 2.0)
+
+        # Stop tracking executions that reached a terminal state, keeping only their counts
+        terminal_states = Counter(
+            state for state in states.values() if state not in (None, 'RUNNING', 'QUEUED')
+        )
+        self.completed_executions.update(terminal_states)
+        self.executions = deque(
+            execution for execution in self.executions
+            if states.get(execution.get('QueryExecutionId')) in (None, 'RUNNING', 'QUEUED')
+        )
 
-            log.debug("Summary of athena executions: {}".format(results))
+        results = self.completed_executions + Counter(
+            state for state in states.values() if state in ('RUNNING', 'QUEUED')
+        )
+        return dict(results)
 
-        return results
+    def partition_fragment(self, table, field_partitions: iter = None) -> str:
+        """
+        Builds the PARTITION (...) LOCATION '...' fragment of an ALTER TABLE statement
+        for one partition of the table.
+
+        :param table: Original name of the table, interpolated into the partition's s3 location
+        :param field_partitions: (optional) field partitions if any
+        :return: partition fragment string
+        """
+        partitions = self.base_partitions_clauses
+        partitions_uri = self.base_partitions_uri
+
+        # The base lists are only copied when there is something to append to them
+        if field_partitions:
+            partitions = partitions + [
+                partition_clause(partition_field, value) for partition_field, value in field_partitions.items()
+            ]
+            partitions_uri = partitions_uri + [
+                f"{partition_field}={quote_value(value)}" for partition_field, value in field_partitions.items()
+            ]
+
+        location = 's3://{}/{}/{}/{}/'.format(
+            self.panorama_raw_data_bucket,
+            self.base_prefix,
+            table,
+            '/'.join(partitions_uri))
+
+        return "PARTITION ({}) LOCATION '{}'".format(','.join(partitions), location)
 
     def update_partitions(self, table, field_partitions: iter = None, datalake_table_name: str = None):
         """
@@ -176,25 +417,24 @@ class PanoramaDatalake:
             If there is none, <base_prefix>_raw_<table> will be used.
         :return:
         """
-        # Update partitions in the datalake
-        partitions = []
-        partitions_uri = []
-        if self.base_partitions:
-            for partition_field, value in self.base_partitions.items():
-                partitions.append("{} = '{}'".format(partition_field, value))
-                partitions_uri.append("{}={}".format(partition_field, urllib.parse.quote(value)))
+        self.update_partitions_bulk(table=table, field_partitions_list=[field_partitions],
+                                    datalake_table_name=datalake_table_name)
 
-        if field_partitions:
-            for partition_field, value in field_partitions.items():
-                partitions.append("{} = '{}'".format(partition_field, value))
-                partitions_uri.append("{}={}".format(partition_field, urllib.parse.quote(value)))
+    def update_partitions_bulk(self, table, field_partitions_list: list, datalake_table_name: str = None):
+        """
+        Adds all the partitions in field_partitions_list to the table in bulk
+        ALTER TABLE statements of up to partitions_per_query partitions each, so
+        registering many partitions costs a few Athena executions instead of one
+        per partition while staying under Athena's query string size limit.
 
-        partitions_clause = ','.join(partitions)
-        location = 's3://{}/{}/{}/{}/'.format(
-            self.panorama_raw_data_bucket,
-            self.base_prefix,
-            table,
-            '/'.join(partitions_uri))
+        :param table: Original name of the table. Present in the s3 key
+        :param field_partitions_list: list of field partitions dicts, one per partition
+        :param datalake_table_name: (optional) datalake table name. If omitted, will look for the configuration setting.
+            If there is none, <base_prefix>_raw_<table> will be used.
+        :return:
+        """
+        if not field_partitions_list:
+            return
 
         # Use Athena to load the partitions
         if not datalake_table_name:
@@ -202,57 +442,132 @@ class PanoramaDatalake:
             log.debug("No table settings found for {}. Using default datalake name {}.".format(
                 table, datalake_table_name))
 
-        log.info("Updating partitions of {}".format(datalake_table_name))
-        query = "ALTER TABLE {} ADD IF NOT EXISTS PARTITION ({}) LOCATION '{}'".format(
-            datalake_table_name,
-            partitions_clause,
-            location
-        )
+        log.info("Updating {} partitions of {}".format(len(field_partitions_list), datalake_table_name))
+        for start in range(0, len(field_partitions_list), partitions_per_query):
+            query = "ALTER TABLE {} ADD IF NOT EXISTS {}".format(
+                datalake_table_name,
+                ' '.join(self.partition_fragment(table, field_partitions)
+                         for field_partitions in field_partitions_list[start:start + partitions_per_query])
+            )
 
-        log.debug("Updating partitions with {}".format(query))
-        self.query_athena(query)
+            log.debug("Updating partitions with {}".format(query))
+            self.query_athena(query)
 
-    def upload_table_from_file(self, filename: str, table: str, field_partitions: iter = None,
-                               update_partitions: bool = False) -> None:
+    def get_table_key(self, table: str, field_partitions: iter = None, filename: str = None) -> str:
         """
-        Upload a file to S3 and -optionally- update the table partitions
-        The complete path will be:
-        s3://<bucket>/<base_prefix>/<table>/<base partitions>/<field partitions>/filename
-        Bucket, base_prefix and base_partitions are set in the PanoramaDatalake instance
+        Build the S3 key of a table file:
+        <base_prefix>/<table>/<base partitions>/<field partitions>/filename
+        Base_prefix and base_partitions are set in the PanoramaDatalake instance
 
-        :param filename: file to be uploaded
         :param table: table name represented in the file
         :param field_partitions: (optional) list of field name and value pairs to be represented as partitions in Hive
             format <field_name>=<value>
-        :param update_partitions: (optional). If set to True, will call update partition on this object. Default: False
-        :return: None
+        :param filename: name of the file in the datalake
+        :return: the S3 key
         """
 
         # Base prefix of the file in the S3 buckets. If there is a base_prefix configured, then we start from there.
         # Otherwise, we start from the root of the bucket. The next folder is the table name.
         # Next, the list of base partitions definitions for all tables in Hive format
         # The complete prefix will be the base prefix plus any specific partitions defined for the table
-        # The complete path will be:
-        #
         if self.base_prefix:
             prefix_list = [self.base_prefix, table]
         else:
             prefix_list = [table]
 
-        if self.base_partitions:
-            for key, value in self.base_partitions.items():
-                prefix_list.append("{}={}".format(key, urllib.parse.quote(value)))
+        prefix_list.extend(self.base_partitions_uri)
 
         if field_partitions:
             for key, value in field_partitions.items():
-                prefix_list.append("{}={}".format(key, urllib.parse.quote(value)))
+                prefix_list.append(f"{key}={quote_value(value)}")
 
         prefix_list.append(filename)
 
-        key = "/".join(prefix_list)
+        return "/".join(prefix_list)
+
+    def remove_legacy_object(self, key: str) -> None:
+        """
+        Deletes the uncompressed csv object that previous versions uploaded under the
+        same prefix as a .csv.gz key. Athena reads every object under a table location,
+        so leaving the old file behind would duplicate (and keep stale) rows after an
+        upgrade.
+
+        :param key: key of the .csv.gz object just uploaded
+        :return: None
+        """
+        legacy_key = key[:-len('.gz')]
+        try:
+            self.s3_client.delete_object(Bucket=self.panorama_raw_data_bucket, Key=legacy_key)
+        except ClientError as e:
+            log.warning("Could not remove legacy object %s: %s", legacy_key, e)
+
+    def upload_table_from_file(self, filename: str, table: str, field_partitions: iter = None,
+                               update_partitions: bool = False, key_filename: str = None) -> None:
+        """
+        Upload a file to S3 and -optionally- update the table partitions
+        The complete path will be:
+        s3://<bucket>/<base_prefix>/<table>/<base partitions>/<field partitions>/filename
+        Bucket, base_prefix and base_partitions are set in the PanoramaDatalake instance
+
+        :param filename: file to be uploaded
+        :param table: table name represented in the file
+        :param field_partitions: (optional) list of field name and value pairs to be represented as partitions in Hive
+            format <field_name>=<value>
+        :param update_partitions: (optional). If set to True, will call update partition on this object. Default: False
+        :param key_filename: (optional) name of the file in the datalake. If omitted, the local filename is used.
+            Useful when the local file has a unique temporary name but the object must keep a stable key.
+        :return: None
+        """
+
+        key = self.get_table_key(table=table, field_partitions=field_partitions,
+                                 filename=key_filename or filename)
 
         log.info("Uploading to {}".format(key))
-        self.s3_client.upload_file(filename, self.panorama_raw_data_bucket, key)
+
+        # Gzipped csv files keep their content metadata so consumers decode them transparently
+        extra_args = None
+        if key.endswith('.gz'):
+            extra_args = {'ContentEncoding': 'gzip', 'ContentType': 'text/csv'}
+
+        self.s3_client.upload_file(filename, self.panorama_raw_data_bucket, key,
+                                   Config=self.transfer_config, ExtraArgs=extra_args)
+
+        if key.endswith('.csv.gz'):
+            self.remove_legacy_object(key)
+
+        if update_partitions and (self.base_partitions or field_partitions):
+            self.update_partitions(table=table, field_partitions=field_partitions)
+
+    def upload_table_from_fileobj(self, fileobj, table: str, key_filename: str, field_partitions: iter = None,
+                                  update_partitions: bool = False) -> None:
+        """
+        Upload a table file to S3 from a readable binary file-like object, without requiring
+        a file on the local filesystem. The object is sent as a multipart upload, so the
+        source can be e.g. an in-memory buffer built while extracting the table.
+        The key is built as in upload_table_from_file.
+
+        :param fileobj: readable binary file-like object positioned at the start of the data
+        :param table: table name represented in the file
+        :param key_filename: name of the file in the datalake
+        :param field_partitions: (optional) list of field name and value pairs to be represented as partitions in Hive
+            format <field_name>=<value>
+        :param update_partitions: (optional). If set to True, will call update partition on this object. Default: False
+        :return: None
+        """
+
+        key = self.get_table_key(table=table, field_partitions=field_partitions, filename=key_filename)
+
+        log.info("Uploading to {}".format(key))
+
+        extra_args = None
+        if key.endswith('.gz'):
+            extra_args = {'ContentEncoding': 'gzip', 'ContentType': 'text/csv'}
+
+        self.s3_client.upload_fileobj(fileobj, self.panorama_raw_data_bucket, key,
+                                      Config=self.transfer_config, ExtraArgs=extra_args)
+
+        if key.endswith('.csv.gz'):
+            self.remove_legacy_object(key)
 
         if update_partitions and (self.base_partitions or field_partitions):
             self.update_partitions(table=table, field_partitions=field_partitions)
@@ -272,34 +587,30 @@ class PanoramaDatalake:
         if not datalake_table:
             datalake_table = "{base_prefix}_raw_{table}".format(base_prefix=self.base_prefix, table=table)
 
-        # Remove partition fields from the field list
+        # Remove partition fields from the field list in a single pass, working on a
+        # copy so the caller's list is not mutated
         if field_partitions:
-            for partition_field in field_partitions:
-                fields.remove(partition_field)
+            partitions_set = set(field_partitions)
+            fields = [field for field in fields if field not in partitions_set]
 
         # Build the list of fields
         fields_definitions_list = []
         for field in fields:
-            fields_definitions_list.append('`{field}` string'.format(field=field))
+            fields_definitions_list.append(f'`{field}` string')
         fields_definitions = ','.join(fields_definitions_list)
 
         # Build the partition section
         partitions_definitions_list = []
         if self.base_partitions:
             for base_partition in self.base_partitions:
-                partitions_definitions_list.append('`{partition_field}` string'.format(partition_field=base_partition))
+                partitions_definitions_list.append(f'`{base_partition}` string')
         if field_partitions:
-            for field_partitions in field_partitions:
-                partitions_definitions_list.append(
-                    '`{partition_field}` string'.format(partition_field=field_partitions))
+            for partition_field in field_partitions:
+                partitions_definitions_list.append(f'`{partition_field}` string')
         if partitions_definitions_list:
 
             partitions_definitions = ','.join(partitions_definitions_list)
-            partitions_section = """
-                PARTITIONED BY ( 
-                    {partitions_definitions}
-                  )
-            """.format(partitions_definitions=partitions_definitions)
+            partitions_section = partitions_section_template.format(partitions_definitions=partitions_definitions)
         else:
             partitions_section = ''
 
@@ -310,32 +621,7 @@ class PanoramaDatalake:
             table=table,
         )
 
-        query = """
-            CREATE EXTERNAL TABLE IF NOT EXISTS `{datalake_table}`(
-                {fields_definitions}
-              )
-            {partitions_section}
-            ROW FORMAT SERDE 
-              'org.apache.hadoop.hive.serde2.OpenCSVSerde' 
-            WITH SERDEPROPERTIES ( 
-              'escapeChar'='\\\\', 
-              'quoteChar'='\\"', 
-              'separatorChar'=',') 
-            STORED AS INPUTFORMAT 
-              'org.apache.hadoop.mapred.TextInputFormat' 
-            OUTPUTFORMAT 
-              'org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat'
-            LOCATION
-              '{location}'
-            TBLPROPERTIES (
-              'areColumnsQuoted'='false', 
-              'classification'='csv', 
-              'columnsOrdered'='true', 
-              'compressionType'='none', 
-              'delimiter'=',', 
-              'skip.header.line.count'='1', 
-              'typeOfData'='file')
-        """.format(
+        query = create_table_template.format(
             datalake_table=datalake_table,
             fields_definitions=fields_definitions,
             partitions_section=partitions_section,
@@ -377,39 +663,30 @@ class PanoramaDatalake:
             fields += self.datalake_settings.get('base_partitions')
 
         for field in fields:
+            field_name = field.get('name')
             field_type = field.get('type').upper()
 
             # Numeric types
-            if field_type in ['INT', 'TINYINT', 'SMALLINT', 'MEDIUMINT', 'BIGINT']:
-                fields_definition.append('TRY_CAST("{field}" AS BIGINT) "{field}"'.format(field=field.get('name')))
-            elif field_type in ['FLOAT', 'DOUBLE', 'DECIMAL']:
-                fields_definition.append('TRY_CAST("{field}" AS DOUBLE) "{field}"'.format(field=field.get('name')))
+            cast_type = numeric_casts.get(field_type)
+            if cast_type:
+                fields_definition.append(f'TRY_CAST("{field_name}" AS {cast_type}) "{field_name}"')
 
             # Datetime types
-            elif field_type in ['DATETIME', 'DATE', 'TIMESTAMP', 'TIME', 'YEAR']:
-                fields_definition.append('TRY("date_parse"("{field}", \'%Y-%m-%d %H:%i:%s.%f\')) "{field}"'.format(
-                    field=field.get('name')))
+            elif field_type in datetime_types:
+                fields_definition.append(
+                    f'TRY("date_parse"("{field_name}", \'%Y-%m-%d %H:%i:%s.%f\')) "{field_name}"')
 
-            # JSON types are not supported by Hive views
-            elif field_type == 'JSON':
-                fields_definition.append('NULLIF("{field}", \'NULL\') "{field}"'.format(field=field.get('name')))
-
-            # String types
-            elif field_type in ['CHAR', 'VARCHAR', 'BLOB', 'TEXT', 'TINYBLOB', 'TINYTEXT', 'MEDIUMBLOB', 'MEDIUMTEXT',
-                                'LONGBLOB', 'LONGTEXT', 'ENUM', 'STRING']:
-                fields_definition.append('NULLIF("{field}", \'NULL\') "{field}"'.format(field=field.get('name')))
+            # String types (JSON included, as it is not supported by Hive views)
+            elif field_type in string_types:
+                fields_definition.append(f'NULLIF("{field_name}", \'NULL\') "{field_name}"')
 
             # Other custom types:
             else:
-                fields_definition.append('TRY_CAST("{field}" AS {field_type}) "{field}"'.format(
-                    field=field.get('name'), field_type=field_type))
+                fields_definition.append(f'TRY_CAST("{field_name}" AS {field_type}) "{field_name}"')
 
-        query = """CREATE OR REPLACE VIEW "{view_name}" AS
-        SELECT {fields_definition} 
-        FROM "{database}"."{table_name}"
-        """.format(view_name=view_name,
-                   fields_definition=','.join(fields_definition),
-                   database=self.datalake_db,
-                   table_name=datalake_table_name
-                   )
+        query = create_view_template.format(view_name=view_name,
+                                            fields_definition=','.join(fields_definition),
+                                            database=self.datalake_db,
+                                            table_name=datalake_table_name
+                                            )
         self.query_athena(query)
@@ -6,30 +6,74 @@ panorama --help
 
 """
 import logging
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import yaml
 
-import click
-
-from panorama_elt.course_structures_datasource.course_structures_datasource import CourseStructuresDatasource
-from panorama_elt.csv_datasource.csv_datasource import CSVDatasource
-from panorama_elt.mysql_datasource.mysql_datasource import MySQLDatasource
-from panorama_elt.xls_datasource.xls_datasource import XLSDatasource
+try:
+    # libyaml C bindings, several times faster than the pure python parser and emitter
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
 
-from panorama_elt.panorama_datalake.panorama_datalake import PanoramaDatalake
+import click
 
 from panorama_elt.panorama_logger.setup_logger import log
 from panorama_elt.__about__ import __version__
 
 
+@lru_cache(maxsize=None)
+def _parse_settings(config_file: str, mtime_ns: int, size: int) -> dict:
+    """
+    Parse config_file as settings. The mtime and size arguments only key the cache,
+    so the file is re-parsed when it changes on disk.
+    Parsed settings are also kept in a pickle sidecar next to the settings file, so
+    repeated CLI invocations skip the YAML parse until the file changes.
+    :return: settings structure
+    """
+    cache_file = config_file + '.cache.pkl'
+    try:
+        with open(cache_file, 'rb') as f:
+            cached_key, cached_settings = pickle.load(f)
+        if cached_key == (mtime_ns, size):
+            return cached_settings
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        pass
+
+    # The file is read as a single bytes buffer so the parser consumes it directly,
+    # instead of going through per-chunk reads and a python text wrapper
+    with open(config_file, 'rb') as f:
+        data = f.read()
+
+    settings = yaml.load(data, Loader=YamlLoader)
+
+    # Refresh the sidecar atomically. A read-only settings directory is not an error.
+    try:
+        with open(cache_file + '.tmp', 'wb') as f:
+            pickle.dump(((mtime_ns, size), settings), f, protocol=pickle.HIGHEST_PROTOCOL)
+        # The sidecar duplicates the credentials in the settings file: give it
+        # the same permissions instead of the umask default
+        os.chmod(cache_file + '.tmp', os.stat(config_file).st_mode)
+        os.replace(cache_file + '.tmp', cache_file)
+    except OSError:
+        log.debug("Could not write settings cache file %s", cache_file)
+
+    return settings
+
+
 def load_settings(config_file: str) -> dict:
     """
     Load config_file as settings.
+    Parsed settings are cached keyed by path, mtime and size, so repeated loads of an
+    unchanged file skip the YAML parse.
     :return: settings structure
     """
     try:
-        with open(config_file, 'r') as f:
-            yaml_settings = yaml.safe_load(f)
+        stat = os.stat(config_file)
+        yaml_settings = _parse_settings(config_file, stat.st_mtime_ns, stat.st_size)
     except FileNotFoundError:
         log.error("No config file {} found".format(config_file))
         exit(1)
@@ -37,13 +81,56 @@ def load_settings(config_file: str) -> dict:
     return yaml_settings
 
 
+def validate_settings(settings) -> None:
+    """
+    Check the overall shape of the settings once after loading, so missing sections fail
+    here with a clear message instead of as None errors deep in a command.
+    :param settings: settings structure
+    :return:
+    """
+    if not isinstance(settings, dict):
+        log.error("Settings file is not a valid settings structure")
+        exit(1)
+
+    if not settings.get('datalake'):
+        log.error("No datalake section defined in the settings file")
+        exit(1)
+
+    datasources = settings.get('datasources')
+    if not datasources:
+        log.error("No datasources defined in the settings file")
+        exit(1)
+
+    for ds_settings in datasources:
+        if not ds_settings.get('name') or not ds_settings.get('type'):
+            log.error("Each datasource must have a name and a type")
+            exit(1)
+        if ds_settings.get('tables') is None:
+            # A missing tables key is a bootstrap state, not an error: set-tables is
+            # the command that populates it. Normalize to an empty list so commands
+            # that consume tables simply have nothing to do.
+            log.warning("No tables defined for datasource {}".format(ds_settings.get('name')))
+            ds_settings['tables'] = []
+
+
 def save_settings(config_file, settings) -> None:
     """
     Save config_file from settings
     :return: settings structure
     """
-    with open(config_file, 'w') as f:
-        yaml.safe_dump(settings, f, sort_keys=False)
+    # Dump to a temporary file and rename, so a failure mid-dump cannot leave a
+    # truncated settings file behind
+    tmp_file = config_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        yaml.dump(settings, f, Dumper=YamlDumper, sort_keys=False, default_flow_style=False, allow_unicode=True,
+                  width=4096)
+    # The settings file holds credentials: keep its permissions instead of the
+    # umask default the temporary file was created with
+    try:
+        os.chmod(tmp_file, os.stat(config_file).st_mode)
+    except FileNotFoundError:
+        pass
+    os.replace(tmp_file, config_file)
 
 
 @click.group()
@@ -63,31 +150,80 @@ def cli(ctx, debug, file):
     config_file = file
     # Load settings file
     settings = load_settings(config_file)
+    validate_settings(settings)
 
-    datalake_settings = settings.get('datalake')
-
-    # Create the datalake object
-    datalake = PanoramaDatalake(datalake_settings)
-
-    ctx.obj['datalake'] = datalake
+    # The datalake object is constructed lazily by _get_datalake, so subcommands
+    # that don't reach the datalake skip the boto3 session setup
     ctx.obj['config_file'] = config_file
     ctx.obj['settings'] = settings
 
 
-def _get_datasource(datalake, ds_settings):
+def _get_datalake(ctx):
+    """
+    Returns the datalake object of this CLI run, constructing it on first use.
+    The import is local so commands that never reach the datalake don't pay
+    the boto3 import on startup.
+    :param ctx: click context
+    :return: shared PanoramaDatalake instance
+    """
+    datalake = ctx.obj.get('datalake')
+    if not datalake:
+        from panorama_elt.panorama_datalake.panorama_datalake import PanoramaDatalake
+
+        settings = ctx.obj.get('settings')
+        datalake = PanoramaDatalake(datalake_settings=settings.get('datalake'))
+        ctx.obj['datalake'] = datalake
+
+    return datalake
+
+
+def _datalake_table_names(base_prefix: str, table_setting: dict) -> tuple:
+    """
+    Returns the datalake table and view names of a table setting in a single pass,
+    falling back to the default <base_prefix>_raw_<table> and <base_prefix>_table_<table>
+    names when they are not configured.
+    :param base_prefix: datalake base prefix
+    :param table_setting: table settings dict
+    :return: (datalake table name, datalake view name)
+    """
+    table_name = table_setting.get('name')
+    datalake_table_name = table_setting.get('datalake_table_name') or "{}_raw_{}".format(base_prefix, table_name)
+    datalake_view_name = table_setting.get('datalake_table_view') or "{}_table_{}".format(base_prefix, table_name)
+
+    return datalake_table_name, datalake_view_name
+
+
+def _get_datasource(ctx, datalake, ds_settings):
+    """
+    Returns the datasource object for a datasource settings entry.
+    Instances are cached in the click context by datasource name, so commands that visit
+    the same datasource more than once in a run reuse its database connections instead
+    of opening new ones.
+    """
+
+    datasources = ctx.obj.setdefault('datasources', {})
+    ds_name = ds_settings.get('name')
+    if ds_name in datasources:
+        return datasources.get(ds_name)
 
+    # The datasource modules are imported on demand so a run only pays the import
+    # cost of the database drivers it actually uses
     ds_type = ds_settings.get('type')
     if ds_type == 'mysql':
+        from panorama_elt.mysql_datasource.mysql_datasource import MySQLDatasource
         datasource = MySQLDatasource(datalake=datalake, datasource_settings=ds_settings)
 
     elif ds_type == 'openedx_course_structures':
+        from panorama_elt.course_structures_datasource.course_structures_datasource import \
+            CourseStructuresDatasource
         datasource = CourseStructuresDatasource(datalake=datalake, datasource_settings=ds_settings)
 
     elif ds_type == 'csv':
+        from panorama_elt.csv_datasource.csv_datasource import CSVDatasource
         datasource = CSVDatasource(datalake=datalake, datasource_settings=ds_settings)
 
     elif ds_type == 'xls':
-
+        from panorama_elt.xls_datasource.xls_datasource import XLSDatasource
         datasource = XLSDatasource(datalake=datalake, datasource_settings=ds_settings)
 
     else:
@@ -95,6 +231,8 @@ def _get_datasource(datalake, ds_settings):
         exit(1)
         return
 
+    datasources[ds_name] = datasource
+
     return datasource
 
 
@@ -134,16 +272,25 @@ def _extract_and_load(ctx, selected_datasource=None, selected_tables=None, force
     :return:
     """
     settings = ctx.obj.get('settings')
-    datalake = PanoramaDatalake(datalake_settings=settings.get('datalake'))
+    datalake = _get_datalake(ctx)
 
+    datasources = []
     for ds_settings in settings.get('datasources'):
 
         if selected_datasource and ds_settings.get("name") != selected_datasource:
             continue
 
-        datasource = _get_datasource(datalake, ds_settings)
+        datasources.append(_get_datasource(ctx, datalake, ds_settings))
 
-        datasource.extract_and_load(selected_tables=selected_tables, force=force)
+    # The datasources hit disjoint databases and datalake prefixes, so their extractions
+    # are run concurrently and the total time is that of the slowest one
+    with ThreadPoolExecutor(max_workers=len(datasources) or 1) as executor:
+        futures = [
+            executor.submit(datasource.extract_and_load, selected_tables=selected_tables, force=force)
+            for datasource in datasources
+        ]
+        for future in futures:
+            future.result()
 
 
 @cli.command(help='Creates datalake tables for all tables defined in the settings file. '
@@ -181,16 +328,19 @@ def _create_datalake_tables(ctx, datasource=None, tables=None):
     :return:
     """
     settings = ctx.obj.get('settings')
-    datalake = PanoramaDatalake(datalake_settings=settings.get('datalake'))
+    datalake = _get_datalake(ctx)
 
     base_prefix = settings.get('datalake').get('base_prefix')
+    selected_tables = frozenset(tables.split(',')) if tables else None
 
-    # Create tables for all datasources
+    # Collect the table definitions of all datasources
+    jobs = []
     for datasource_settings in settings.get('datasources'):
         if datasource and datasource_settings.get('name') != datasource:
             continue
         for table_setting in datasource_settings.get('tables'):
-            if tables and table_setting.get('name') not in tables.split(','):
+            table_name = table_setting.get('name')
+            if selected_tables and table_name not in selected_tables:
                 continue
 
             partitions = table_setting.get('partitions')
@@ -204,19 +354,25 @@ def _create_datalake_tables(ctx, datasource=None, tables=None):
             if fields_and_types:
                 fields = [f.get("name") for f in fields_and_types]
 
-                datalake_table_name = table_setting.get('datalake_table_name') or "{}_raw_{}".format(
-                    base_prefix, table_setting.get('name'))
+                datalake_table_name, _ = _datalake_table_names(base_prefix, table_setting)
 
-                log.info("Creating or updating datalake table for {}".format(table_setting.get('name')))
-                datalake.create_datalake_table(
-                    table=table_setting.get('name'),
+                log.info("Creating or updating datalake table for %s", table_name)
+                jobs.append(dict(
+                    table=table_name,
                     fields=fields,
                     field_partitions=partition_fields,
                     datalake_table=datalake_table_name
-                )
+                ))
 
             else:
-                log.warning("No fields defined for table {}. Skipping table creation".format(table_setting.get('name')))
+                log.warning("No fields defined for table %s. Skipping table creation", table_name)
+
+    # Each create_datalake_table call is one Athena submission roundtrip, so the DDL of
+    # all tables is submitted concurrently and polled once at the end
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        futures = [executor.submit(datalake.create_datalake_table, **job) for job in jobs]
+        for future in futures:
+            future.result()
 
     click.echo(datalake.get_athena_executions())
 
@@ -255,26 +411,24 @@ def _drop_datalake_tables(ctx, datasource=None, tables=None):
     :return:
     """
     settings = ctx.obj.get('settings')
-    datalake = PanoramaDatalake(datalake_settings=settings.get('datalake'))
+    datalake = _get_datalake(ctx)
 
     # Create tables for all datasources
     base_prefix = settings.get('datalake').get('base_prefix')
+    selected_tables = frozenset(tables.split(',')) if tables else None
     for datasource_settings in settings.get('datasources'):
         if datasource and datasource_settings.get('name') != datasource:
             continue
         for table_setting in datasource_settings.get('tables'):
-            if tables and table_setting.get('name') not in tables.split(','):
+            if selected_tables and table_setting.get('name') not in selected_tables:
                 continue
 
-            datalake_table_name = table_setting.get('datalake_table_name') or "{}_raw_{}".format(
-                base_prefix, table_setting.get('name'))
-            datalake_view_name = table_setting.get('datalake_table_view') or "{}_table_{}".format(
-                base_prefix, table_setting.get('name'))
+            datalake_table_name, datalake_view_name = _datalake_table_names(base_prefix, table_setting)
 
-            log.info("Dropping {}".format(datalake_table_name))
+            log.info("Dropping %s", datalake_table_name)
             datalake.drop_datalake_table(datalake_table=datalake_table_name)
 
-            log.info("Dropping {}".format(datalake_view_name))
+            log.info("Dropping %s", datalake_view_name)
             datalake.drop_datalake_view(view=datalake_view_name)
 
     click.echo(datalake.get_athena_executions())
@@ -310,9 +464,10 @@ def create_table_views(ctx, all_, datasource, tables):
 
 def _create_table_view(ctx, datasource=None, tables=None):
     settings = ctx.obj.get('settings')
-    datalake = PanoramaDatalake(datalake_settings=settings.get('datalake'))
+    datalake = _get_datalake(ctx)
 
     base_prefix = settings.get('datalake').get('base_prefix')
+    selected_tables = frozenset(tables.split(',')) if tables else None
     for datasource_settings in settings.get('datasources'):
         if datasource and datasource_settings.get('name') != datasource:
             continue
@@ -320,25 +475,22 @@ def _create_table_view(ctx, datasource=None, tables=None):
         for table_setting in datasource_settings.get('tables'):
 
             table_name = table_setting.get('name')
-            if tables and table_name not in tables.split(','):
+            if selected_tables and table_name not in selected_tables:
                 continue
 
-            log.debug("Creating table view for table {} in datasource {}".format(
-                table_name, datasource_settings.get('name')))
+            log.debug("Creating table view for table %s in datasource %s",
+                      table_name, datasource_settings.get('name'))
 
             fields = table_setting.get('fields')
             if fields:
-                datalake_table_name = table_setting.get('datalake_table_name') or "{}_raw_{}".format(
-                    base_prefix, table_setting.get('name'))
-                datalake_view_name = table_setting.get('datalake_table_view') or "{}_table_{}".format(
-                    base_prefix, table_setting.get('name'))
+                datalake_table_name, datalake_view_name = _datalake_table_names(base_prefix, table_setting)
 
-                log.info("Creating table view {}".format(datalake_view_name))
+                log.info("Creating table view %s", datalake_view_name)
 
                 datalake.create_table_view(datalake_table_name=datalake_table_name, view_name=datalake_view_name,
                                            fields=fields)
             else:
-                log.warning("No fields defined for table {}".format(table_name))
+                log.warning("No fields defined for table %s", table_name)
 
     click.echo(datalake.get_athena_executions())
 
@@ -382,7 +534,7 @@ def _set_tables(ctx, datasource: str = None, tables: str = None) -> None:
     :return: None
     """
     settings = ctx.obj.get('settings')
-    datalake = PanoramaDatalake(datalake_settings=settings.get('datalake'))
+    datalake = _get_datalake(ctx)
     config_file = ctx.obj.get('config_file')
 
     for ds_settings in settings.get('datasources'):
@@ -390,11 +542,11 @@ def _set_tables(ctx, datasource: str = None, tables: str = None) -> None:
         if datasource and datasource != ds_settings.get('name'):
             continue
 
-        datasource = _get_datasource(datalake, ds_settings)
-        ds_tables = datasource.get_tables()
+        ds_datasource = _get_datasource(ctx, datalake, ds_settings)
+        ds_tables = ds_datasource.get_tables()
 
         if tables:
-            selected_tables = tables.split(',')
+            selected_tables = frozenset(tables.split(','))
             table_list = [t for t in ds_tables if t in selected_tables]
         else:
             table_list = ds_tables
@@ -443,26 +595,41 @@ def _set_tables_fields(ctx, datasource=None, tables=None):
     :return:
     """
     settings = ctx.obj.get('settings')
-    datalake = PanoramaDatalake(datalake_settings=settings.get('datalake'))
+    datalake = _get_datalake(ctx)
     config_file = ctx.obj.get('config_file')
+    selected_tables = frozenset(tables.split(',')) if tables else None
 
     for ds_settings in settings.get('datasources'):
 
         if datasource and datasource != ds_settings.get('name'):
             continue
 
-        for table_settings in ds_settings.get('tables'):
+        ds_datasource = _get_datasource(ctx, datalake, ds_settings)
 
-            table_name = table_settings.get('name')
-            if tables and table_name not in tables.split(','):
-                continue
+        tables_settings = [
+            t for t in ds_settings.get('tables')
+            if not selected_tables or t.get('name') in selected_tables
+        ]
 
-            log.debug("Setting fields for table {} in datasource {}".format(
-                table_name, ds_settings.get('name')))
+        # MySQL datasources can resolve the fields of all their tables in a single
+        # INFORMATION_SCHEMA round trip instead of one query per table.
+        # Skip the call when no table of this datasource was selected.
+        if ds_settings.get('type') == 'mysql' and tables_settings:
+            fields_by_table = ds_datasource.get_all_fields([t.get('name') for t in tables_settings])
+        else:
+            fields_by_table = None
 
-            datasource = _get_datasource(datalake, ds_settings)
+        for table_settings in tables_settings:
 
-            table_fields = datasource.get_fields(table=table_name, force_query=True)
+            table_name = table_settings.get('name')
+
+            log.debug("Setting fields for table %s in datasource %s",
+                      table_name, ds_settings.get('name'))
+
+            if fields_by_table is not None:
+                table_fields = fields_by_table.get(table_name, [])
+            else:
+                table_fields = ds_datasource.get_fields(table=table_name, force_query=True)
             table_settings['fields'] = table_fields
 
     save_settings(config_file=config_file, settings=settings)
@@ -474,18 +641,17 @@ def _set_tables_fields(ctx, datasource=None, tables=None):
 @click.pass_context
 def test_connections(ctx):
     settings = ctx.obj.get('settings')
-    datalake_settings = settings.get('datalake')
 
     results = []
 
     click.echo("Testing datalake...")
-    datalake = PanoramaDatalake(datalake_settings=datalake_settings)
+    datalake = _get_datalake(ctx)
     results.append(datalake.test_connections())
 
     for datasource_settings in settings.get('datasources'):
         click.echo("Testing {}...".format(datasource_settings.get('name')))
 
-        datasource = _get_datasource(datalake, datasource_settings)
+        datasource = _get_datasource(ctx, datalake, datasource_settings)
         results.append(datasource.test_connections())
 
     for r in results:
@@ -6,7 +6,8 @@ Do not leave empty rows or columns.
 The first row must have the field names.
 """
 import csv
-import os
+import gzip
+import io
 
 import openpyxl
 
@@ -14,6 +15,22 @@ from panorama_elt.panorama_datalake.panorama_datalake import PanoramaDatalake
 from panorama_elt.panorama_logger.setup_logger import log
 
 
+def sheet_rows(sheet, max_col: int) -> iter:
+    """
+    Generator over the data rows of a sheet, so rows go to the csv writer as they are
+    parsed instead of being collected in a list first.
+    Stops at the first empty row, as the sheet must have no gaps.
+
+    :param sheet: worksheet to read
+    :param max_col: number of columns to read per row
+    :return: generator of value tuples
+    """
+    for row in sheet.iter_rows(min_row=2, max_col=max_col, values_only=True):
+        if all(v is None for v in row):
+            return
+        yield row
+
+
 class XLSDatasource:
     """
     Settings required:
@@ -38,6 +55,22 @@ class XLSDatasource:
         self.location = datasource_settings.get('location')
         self.datalake = datalake
 
+        # Workbook already opened, so the file is parsed once per run at most
+        self._workbook = None
+
+    def _get_workbook(self):
+        """
+        Returns the read-only workbook of the file, opening it on first use and reusing
+        it afterwards: loading the workbook is the expensive part on large files.
+
+        :return: openpyxl workbook
+        """
+        if self._workbook is None:
+            # read_only streams the sheet XML instead of building the full in-memory
+            # workbook, which for large files is orders of magnitude faster and lighter
+            self._workbook = openpyxl.load_workbook(self.location, read_only=True, data_only=True)
+        return self._workbook
+
     def test_connections(self) -> dict:
         """
         Performs connections test
@@ -55,8 +88,7 @@ class XLSDatasource:
         Returns the list of sheet names, as a list of tables
         :return: list of sheet names
         """
-        workbook = openpyxl.load_workbook(self.location)
-        return workbook.get_sheet_names()
+        return self._get_workbook().sheetnames
 
     def get_fields(self, table: str, force_query: bool = False) -> list:
         """
@@ -72,18 +104,17 @@ class XLSDatasource:
         if self.table_fields and self.table_fields.get(table) and not force_query:
             return self.table_fields.get(table)
 
-        workbook = openpyxl.load_workbook(self.location)
-        sheet = workbook.get_sheet_by_name(table)
-        fields = []
+        sheet = self._get_workbook()[table]
 
-        colnum = 1
-        value = sheet.cell(row=1, column=1).value
-        while value:
-            fields.append(value)
-            colnum += 1
-            value = sheet.cell(row=1, column=colnum).value
+        # Read the header in one pass instead of one cell lookup per column: in
+        # read-only mode each cell() call re-parses the sheet up to that cell
+        header = next(sheet.iter_rows(min_row=1, max_row=1, values_only=True), ())
 
-        workbook.close()
+        fields = []
+        for value in header:
+            if not value:
+                break
+            fields.append(value)
 
         log.debug("Fields in table: {}".format(fields))
 
@@ -102,30 +133,30 @@ class XLSDatasource:
         :return:
         """
 
-        workbook = openpyxl.load_workbook(self.location)
+        workbook = self._get_workbook()
         for table, fields in self.table_fields.items():
-            sheet = workbook.get_sheet_by_name(table)
-
-            rownum = 2
-            dataset = []
-            while rownum < 1000000:
-                row = []
-                for colnum in range(len(fields)):
-                    row.append(sheet.cell(row=rownum, column=colnum+1).value)
-                rownum += 1
-                if all([v is None for v in row]):
-                    break
-                dataset.append(row)
-
-            # Save the dataset in a csv file
-            filename = "{}.csv".format(table)
-            with open(filename, 'w') as f:
+            sheet = workbook[table]
+
+            # Write the gzipped csv into an in-memory buffer and upload it directly,
+            # streaming the rows from the sheet parser straight to the writer: no
+            # dataset list and no temporary file on disk. Level 1 shrinks the text
+            # severalfold at near disk-bound speed, and Athena reads gzipped csv
+            # natively.
+            buffer = io.BytesIO()
+            with gzip.open(buffer, 'wt', compresslevel=1) as f:
                 write = csv.writer(f, doublequote=False, escapechar='\\')
                 write.writerow(fields)
-                write.writerows(dataset)
-
-            self.datalake.upload_table_from_file(filename=filename, table=table, update_partitions=True)
+                write.writerows(sheet_rows(sheet, len(fields)))
 
-            os.remove(filename)
+            buffer.seek(0)
+            self.datalake.upload_table_from_fileobj(
+                fileobj=buffer, table=table, key_filename="{}.csv.gz".format(table), update_partitions=True)
 
-        workbook.close()
+    def close(self) -> None:
+        """
+        Closes the cached workbook, if one was opened
+        :return: None
+        """
+        if self._workbook is not None:
+            self._workbook.close()
+            self._workbook = None